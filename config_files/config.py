@@ -160,6 +160,8 @@ n_transitions_to_plot_in_distribution_curves = 1000
 make_highest_prio_figures = False
 apply_randomcrop_augmentation = False
 n_pixels_to_crop_on_each_side = 2
+# Replay the GPU part of BufferCollator (mini-race logic and augmentations) as a CUDA graph to reduce kernel launch overhead.
+use_cuda_graph_for_batch_postprocessing = False
 
 max_rollout_queue_size = 1
 
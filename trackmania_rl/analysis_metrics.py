@@ -189,7 +189,7 @@ def highest_prio_transitions(buffer, save_dir):
     shutil.rmtree(save_dir / "high_prio_figures", ignore_errors=True)
     (save_dir / "high_prio_figures").mkdir(parents=True, exist_ok=True)
 
-    prios = [buffer._sampler._sum_tree.at(i) for i in range(len(buffer))]
+    prios = buffer._sampler.priorities(len(buffer))
 
     for high_error_idx in np.argsort(prios)[-20:]:
         for idx in range(max(0, high_error_idx - 4), min(len(buffer) - 1, high_error_idx + 5)):
@@ -2,50 +2,193 @@
 This file contains various utility functions used to manage replay buffers.
 This is where the magic of "mini-races" or "clipped horizon average reward" is handled.
 """
-import random
-from copy import deepcopy
+from collections import OrderedDict
+from pathlib import Path
 from typing import Any, Dict, Union
 
 import numpy as np
 import torch
-import torchvision.transforms.v2 as transforms
 from torch import Tensor
-from torchrl.data import ListStorage, ReplayBuffer
-from torchrl.data.replay_buffers.samplers import PrioritizedSampler, RandomSampler
+from torchrl.data import ReplayBuffer
+from torchrl.data.replay_buffers.samplers import RandomSampler, Sampler
 from torchrl.data.replay_buffers.storages import Storage
-from torchrl.data.replay_buffers.utils import INT_CLASSES, _to_numpy
+from torchrl.data.replay_buffers.utils import INT_CLASSES
 
 from config_files import config_copy
-
-to_torch_dtype = {
-    "uint8": torch.uint8,
-    "float32": torch.float32,
-    "int64": torch.int64,
-    "float": torch.float32,
-    "int": torch.int,
-    "float64": torch.float32,
+from trackmania_rl.experience_replay.experience_replay_interface import Experience
+
+# Dtype in which each non-image Experience attribute is stored and collated. A fixed schema is used because the type of a value
+# depends on the transition (e.g. next_state_potential is the integer 0 at the finish line).
+# state_float, rewards and gammas are already float32 when they are produced; only the values built from Python floats
+# (state_potential, next_state_potential, terminal_actions) are narrowed from 64 bits when they are stored. Float inputs
+# are not narrowed further (e.g. to bfloat16), because the network normalizes them with float_inputs_mean/float_inputs_std in
+# float32, and raw values such as positions or engine RPM need more than bfloat16's 8 bits of mantissa.
+experience_storage_dtypes = {
+    "state_float": np.float32,
+    "state_potential": np.float32,
+    "action": np.int64,
+    "n_steps": np.int64,
+    "rewards": np.float32,
+    "next_state_float": np.float32,
+    "next_state_potential": np.float32,
+    "gammas": np.float32,
+    "terminal_actions": np.float32,
 }
 
+# Pinned host buffers are expensive to allocate (cudaHostAlloc is synchronous): each BufferCollator allocates them once and reuses
+# them for every batch.
+max_pinned_buffers = 64
+# Side streams used by each BufferCollator to keep several host-to-device copies in flight at once.
+n_copy_streams = 3
+# With prefetch, a batch is collated while the previous one is still used for training: graphs are used in turns so that
+# a replay never overwrites the batch being trained on.
+n_batch_postprocessing_graphs = 2
+
+collated_attr_names = (
+    "state_img",
+    "state_float",
+    "state_potential",
+    "action",
+    "rewards",
+    "next_state_img",
+    "next_state_float",
+    "next_state_potential",
+    "gammas",
+    "terminal_actions",
+    "n_steps",
+)
+
+
+class ExperienceBatch:
+    """
+    Batch of transitions returned by ExperienceArrayStorage.get() and consumed by BufferCollator.
+
+    arrays maps each Experience attribute to an array of shape (batch_size, *attribute_shape). Images are object arrays of
+    references to frames. The arrays are a snapshot taken when the batch was read from the storage: they are not affected by
+    memories written to the storage afterwards.
+    """
+
+    __slots__ = ("arrays",)
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.arrays = arrays
+
+    def __len__(self) -> int:
+        return len(next(iter(self.arrays.values()))) if self.arrays else 0
+
+
+class ExperienceArrayStorage(Storage):
+    """
+    Struct-of-arrays storage for Experience objects.
+
+    Each attribute is stored in an array of shape (max_size, *attribute_shape), in the dtype it is collated to, so that
+    collating a batch is a vectorized gather per attribute instead of a Python loop over Experience objects.
+    Images are stored in object arrays of references: frames are shared between transitions (a frame is the state_img of
+    one transition and the next_state_img of others), copying them would multiply the memory footprint of the buffer.
+
+    Indexing with an integer, or iterating over the storage, rebuilds Experience objects for code that inspects individual
+    transitions. Any other index (slice, array of indices) returns an ExperienceBatch.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        super(ExperienceArrayStorage, self).__init__(max_size)
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._n_experiences = 0
+
+    def _allocate(self, shapes: Dict[str, tuple]) -> None:
+        for attr_name in Experience.__slots__:
+            if "img" in attr_name:
+                self._arrays[attr_name] = np.empty(self.max_size, dtype=object)
+            else:
+                self._arrays[attr_name] = np.zeros((self.max_size,) + shapes[attr_name], dtype=experience_storage_dtypes[attr_name])
+
+    def _check_cursor(self, cursor: int) -> None:
+        if cursor > self._n_experiences:
+            raise RuntimeError(
+                f"Cannot append data located more than one item away from the storage size: the storage size is {len(self)} "
+                f"and the index of the item to be set is {cursor}."
+            )
+
+    def set(self, cursor: Union[int, slice, np.ndarray, Tensor], data: Any) -> None:
+        if not isinstance(cursor, INT_CLASSES):
+            if isinstance(cursor, slice):
+                cursor = range(*cursor.indices(self.max_size))
+            cursor = np.asarray(cursor).reshape(-1)
+            if isinstance(data, ExperienceBatch):
+                # Vectorized write, used when copying memories from another ExperienceArrayStorage.
+                if len(cursor) == 0:
+                    return
+                self._check_cursor(int(cursor[0]))
+                if not self._arrays:
+                    self._allocate({attr_name: array.shape[1:] for attr_name, array in data.arrays.items()})
+                for attr_name, array in self._arrays.items():
+                    array[cursor] = data.arrays[attr_name]
+                self._n_experiences = max(self._n_experiences, int(cursor.max()) + 1)
+                return
+            for _cursor, _data in zip(cursor, data):
+                self.set(int(_cursor), _data)
+            return
+        self._check_cursor(cursor)
+        if not self._arrays:
+            self._allocate({attr_name: np.shape(getattr(data, attr_name)) for attr_name in Experience.__slots__})
+        for attr_name, array in self._arrays.items():
+            array[cursor] = getattr(data, attr_name)
+        self._n_experiences = max(self._n_experiences, cursor + 1)
+
+    def _get_experience(self, index: int) -> Experience:
+        if not -self._n_experiences <= index < self._n_experiences:
+            raise IndexError(f"index {index} is out of range for a storage of size {self._n_experiences}")
+        index %= self._n_experiences
+        return Experience(**{attr_name: array[index] for attr_name, array in self._arrays.items()})
+
+    def get(self, index: Union[int, slice, np.ndarray, Tensor]) -> Union[Experience, ExperienceBatch]:
+        if isinstance(index, INT_CLASSES):
+            return self._get_experience(int(index))
+        if isinstance(index, slice):
+            # ReplayBuffer.__getitem__ passes the result of non-integer indexing to collate_fn, which expects an ExperienceBatch.
+            index = np.arange(*index.indices(self._n_experiences))
+        # torchrl calls get() while holding the replay buffer's lock, but calls collate_fn after releasing it (in the prefetch
+        # thread): rows are gathered here so that a concurrent add() cannot overwrite a sampled memory while it is collated.
+        index = np.asarray(index).reshape(-1)
+        return ExperienceBatch({attr_name: array.take(index, axis=0) for attr_name, array in self._arrays.items()})
+
+    def __iter__(self):
+        for i in range(self._n_experiences):
+            yield self._get_experience(i)
+
+    def __len__(self) -> int:
+        return self._n_experiences
+
+    def _empty(self) -> None:
+        self._arrays = {}
+        self._n_experiences = 0
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"_arrays": self._arrays, "_n_experiences": self._n_experiences}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self._arrays = state_dict["_arrays"]
+        self._n_experiences = state_dict["_n_experiences"]
 
-def fast_collate_cpu(batch, attr_name):
-    elem = getattr(batch[0], attr_name)
-    elem_array = hasattr(elem, "__len__")
-    shape = (len(batch),) + (elem.shape if elem_array else ())
-    data_type = elem.flat[0].dtype if elem_array else type(elem).__name__
-    data_type = to_torch_dtype[str(data_type)]
-    buffer = torch.empty(size=shape, dtype=data_type, pin_memory=True).numpy()
-    source = [getattr(memory, attr_name) for memory in batch]
-    buffer[:] = source[:]
-    return buffer
+    def dumps(self, path) -> None:
+        raise NotImplementedError("ExperienceArrayStorage does not support serialization via the dumps/loads API.")
+
+    def loads(self, path) -> None:
+        raise NotImplementedError("ExperienceArrayStorage does not support serialization via the dumps/loads API.")
 
 
 def send_to_gpu(batch, attr_name):
-    return torch.as_tensor(batch).to(
-        non_blocking=True, device="cuda", memory_format=torch.channels_last if "img" in attr_name else torch.preserve_format
-    )
+    # Image buffers already carry channels_last strides (see BufferCollator.get_pinned_buffer), which preserve_format keeps on the device.
+    return batch.to(non_blocking=True, device="cuda")
 
 
-def buffer_collate_function(batch):
+def postprocess_batch_on_gpu(gpu_batches: list[Tensor]) -> tuple[Tensor, ...]:
+    """
+    Applies the mini-race logic and image augmentations to a batch that has already been transferred to GPU.
+
+    This function only issues GPU work and does not synchronize with the host, so that it can be captured in a CUDA graph.
+    state_float and next_state_float are modified in place.
+    """
     (
         state_img,
         state_float,
@@ -58,43 +201,26 @@ def buffer_collate_function(batch):
         gammas,
         terminal_actions,
         n_steps,
-    ) = tuple(
-        map(
-            lambda attr_name: fast_collate_cpu(batch, attr_name),
-            [
-                "state_img",
-                "state_float",
-                "state_potential",
-                "action",
-                "rewards",
-                "next_state_img",
-                "next_state_float",
-                "next_state_potential",
-                "gammas",
-                "terminal_actions",
-                "n_steps",
-            ],
-        )
-    )
+    ) = gpu_batches
 
     temporal_mini_race_current_time_actions = (
-        np.abs(
-            np.random.randint(
-                low=-config_copy.oversample_long_term_steps + config_copy.oversample_maximum_term_steps,
-                high=config_copy.temporal_mini_race_duration_actions + config_copy.oversample_maximum_term_steps,
-                size=(len(state_img),),
-                dtype=int,
-            )
+        torch.randint(
+            low=-config_copy.oversample_long_term_steps + config_copy.oversample_maximum_term_steps,
+            high=config_copy.temporal_mini_race_duration_actions + config_copy.oversample_maximum_term_steps,
+            size=(len(state_img),),
+            device="cuda",
         )
-        - config_copy.oversample_maximum_term_steps
-    ).clip(min=0)
+        .abs_()
+        .sub_(config_copy.oversample_maximum_term_steps)
+        .clamp_(min=0)
+    )
 
     temporal_mini_race_next_time_actions = temporal_mini_race_current_time_actions + n_steps
 
     state_float[:, 0] = temporal_mini_race_current_time_actions
     next_state_float[:, 0] = temporal_mini_race_next_time_actions
 
-    possibly_reduced_n_steps = n_steps - (temporal_mini_race_next_time_actions - config_copy.temporal_mini_race_duration_actions).clip(
+    possibly_reduced_n_steps = n_steps - (temporal_mini_race_next_time_actions - config_copy.temporal_mini_race_duration_actions).clamp_(
         min=0
     )
 
@@ -102,60 +228,35 @@ def buffer_collate_function(batch):
         temporal_mini_race_next_time_actions >= config_copy.temporal_mini_race_duration_actions
     )
 
-    gammas = np.take_along_axis(gammas, possibly_reduced_n_steps[:, None] - 1, axis=1).squeeze(-1)
-    gammas = np.where(terminal, 0, gammas)
+    # Column of the (batch_size, n_steps) gammas and rewards arrays that matches each transition's effective n_steps.
+    n_steps_index = possibly_reduced_n_steps.sub_(1).unsqueeze_(1)
 
-    rewards = np.take_along_axis(rewards, possibly_reduced_n_steps[:, None] - 1, axis=1).squeeze(-1)
+    gammas = gammas.gather(1, n_steps_index).squeeze_(1)
+    gammas.masked_fill_(terminal, 0)
 
-    rewards += np.where(terminal, 0, gammas * next_state_potential)
-    rewards -= state_potential
+    rewards = rewards.gather(1, n_steps_index).squeeze_(1)
 
-    state_img, state_float, action, rewards, next_state_img, next_state_float, gammas = tuple(
-        map(
-            lambda batch, attr_name: send_to_gpu(batch, attr_name),
-            [
-                state_img,
-                state_float,
-                action,
-                rewards,
-                next_state_img,
-                next_state_float,
-                gammas,
-            ],
-            [
-                "state_img",
-                "state_float",
-                "action",
-                "rewards",
-                "next_state_img",
-                "next_state_float",
-                "gammas",
-            ],
-        )
-    )
+    # gammas is already 0 for terminal transitions, so the next state's potential is only added for non-terminal ones.
+    rewards.addcmul_(gammas, next_state_potential)
+    rewards -= state_potential
 
-    state_img = (state_img.to(torch.float16) - 128) / 128
-    next_state_img = (next_state_img.to(torch.float16) - 128) / 128
+    # state_img and next_state_img receive exactly the same processing: process them as a single batch to halve kernel launches.
+    # Cast once, then normalize in place to avoid allocating two intermediate image tensors.
+    both_img = torch.cat((state_img, next_state_img)).to(torch.float16).sub_(128).mul_(1 / 128)
 
     if config_copy.apply_randomcrop_augmentation:
         # Same transformation is applied for state and next_state.
         # Different transformation is applied to each element in a batch.
-        i = random.randint(0, 2 * config_copy.n_pixels_to_crop_on_each_side)
-        j = random.randint(0, 2 * config_copy.n_pixels_to_crop_on_each_side)
-        state_img = transforms.functional.crop(
-            transforms.functional.pad(state_img, padding=config_copy.n_pixels_to_crop_on_each_side, padding_mode="edge"),
-            i,
-            j,
-            config_copy.H_downsized,
-            config_copy.W_downsized,
-        )
-        next_state_img = transforms.functional.crop(
-            transforms.functional.pad(next_state_img, padding=config_copy.n_pixels_to_crop_on_each_side, padding_mode="edge"),
-            i,
-            j,
-            config_copy.H_downsized,
-            config_copy.W_downsized,
-        )
+        # Offsets are drawn on GPU so that they are not frozen when this function is captured in a CUDA graph.
+        crop_offsets = torch.randint(0, 2 * config_copy.n_pixels_to_crop_on_each_side + 1, size=(2,), device="cuda")
+        crop_offsets -= config_copy.n_pixels_to_crop_on_each_side
+        # Edge padding followed by a crop is equivalent to gathering rows and columns with clamped indices,
+        # which avoids materializing the padded images.
+        row_idx = (torch.arange(config_copy.H_downsized, device="cuda") + crop_offsets[0]).clamp_(0, config_copy.H_downsized - 1)
+        col_idx = (torch.arange(config_copy.W_downsized, device="cuda") + crop_offsets[1]).clamp_(0, config_copy.W_downsized - 1)
+        both_img = both_img[..., row_idx[:, None], col_idx[None, :]]
+
+    state_img, next_state_img = both_img.split(len(state_float))
 
     return (
         state_img,
@@ -168,7 +269,151 @@ def buffer_collate_function(batch):
     )
 
 
-class CustomPrioritizedSampler(PrioritizedSampler):
+class BatchPostprocessingGraph:
+    """
+    CUDA graph of postprocess_batch_on_gpu() for one set of batch shapes.
+
+    Host-to-device copies write into static input tensors, and replay() runs the ~30 small kernels of postprocess_batch_on_gpu()
+    with a single launch. The returned tensors are static: they are overwritten by the next replay of the same graph.
+    """
+
+    def __init__(self, cpu_batches: list[Tensor], graph_pool: tuple) -> None:
+        self.graph_pool = graph_pool
+        self.static_inputs = [torch.empty_like(cpu_batch, device="cuda") for cpu_batch in cpu_batches]
+        self.graph = None
+        self.static_outputs = None
+
+    def replay(self) -> tuple[Tensor, ...]:
+        if self.graph is None:
+            # Captured lazily, once static_inputs contain a real batch: warm-up iterations index with n_steps.
+            # Warm-up and capture only overwrite values that postprocess_batch_on_gpu() recomputes on each replay.
+            warmup_stream = torch.cuda.Stream()
+            warmup_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(warmup_stream):
+                for _ in range(3):
+                    postprocess_batch_on_gpu(self.static_inputs)
+            torch.cuda.current_stream().wait_stream(warmup_stream)
+            self.graph = torch.cuda.CUDAGraph()
+            # The replay buffer may be sampled from several threads: only this thread's CUDA calls are restricted during capture.
+            with torch.cuda.graph(self.graph, pool=self.graph_pool, capture_error_mode="thread_local"):
+                self.static_outputs = postprocess_batch_on_gpu(self.static_inputs)
+        self.graph.replay()
+        return self.static_outputs
+
+
+class BufferCollator:
+    """
+    collate_fn of a ReplayBuffer: copies a sampled ExperienceBatch to GPU and applies postprocess_batch_on_gpu().
+
+    Each replay buffer gets its own collator, which owns the pinned host buffers, copy streams, transfer event and CUDA graphs
+    used for its batches. They are released together with the buffer, e.g. when resize_buffers() replaces it.
+    Batches of one buffer are collated one at a time: with prefetch, in the buffer's single prefetch thread.
+    CUDA objects are created lazily so that building a buffer does not initialize CUDA.
+    """
+
+    def __init__(self) -> None:
+        self.pinned_buffers: OrderedDict[tuple, Tensor] = OrderedDict()
+        self.copy_streams: list[torch.cuda.Stream] = []
+        # Last host-to-device transfer. It must complete before the pinned buffers are overwritten.
+        self.transfer_event = None
+        # Graphs are rebuilt when shapes or config values baked in them change.
+        self.batch_postprocessing_graphs_signature = None
+        self.batch_postprocessing_graphs: list[BatchPostprocessingGraph] = []
+        self.n_batches_collated = 0
+
+    def get_pinned_buffer(self, attr_name: str, shape: tuple, data_type: torch.dtype) -> Tensor:
+        key = (attr_name, shape, str(data_type))
+        if key in self.pinned_buffers:
+            self.pinned_buffers.move_to_end(key)
+        else:
+            if "img" in attr_name and len(shape) == 4:
+                # Images are laid out channels_last on the host, so the host-to-device copy is a plain memcpy
+                # and the GPU tensor already has the layout expected by the convolutions.
+                n, c, h, w = shape
+                tensor = torch.empty(size=(n, h, w, c), dtype=data_type, pin_memory=True).permute(0, 3, 1, 2)
+            else:
+                tensor = torch.empty(size=shape, dtype=data_type, pin_memory=True)
+            self.pinned_buffers[key] = tensor
+            while len(self.pinned_buffers) > max_pinned_buffers:
+                # Copies are issued from the pinned torch tensors themselves, so torch's caching host allocator records an event
+                # for each of them and does not hand an evicted buffer out again before its pending copies have completed.
+                self.pinned_buffers.popitem(last=False)
+        return self.pinned_buffers[key]
+
+    def fast_collate_cpu(self, batch: ExperienceBatch, attr_name):
+        source = batch.arrays[attr_name]
+        if source.dtype == object:
+            # Images are stored as references to frames: stack them directly into the pinned buffer.
+            elem = source[0]
+            buffer = self.get_pinned_buffer(attr_name, (len(batch),) + elem.shape, torch.from_numpy(elem[:0]).dtype)
+            np.stack(source, axis=0, out=buffer.numpy())
+        else:
+            buffer = self.get_pinned_buffer(attr_name, source.shape, torch.from_numpy(source[:0]).dtype)
+            np.copyto(buffer.numpy(), source)
+        return buffer
+
+    def get_batch_postprocessing_graph(self, cpu_batches: list[Tensor]) -> BatchPostprocessingGraph:
+        signature = (
+            tuple((cpu_batch.shape, cpu_batch.dtype) for cpu_batch in cpu_batches),
+            config_copy.oversample_long_term_steps,
+            config_copy.oversample_maximum_term_steps,
+            config_copy.temporal_mini_race_duration_actions,
+            config_copy.apply_randomcrop_augmentation,
+            config_copy.n_pixels_to_crop_on_each_side,
+            config_copy.H_downsized,
+            config_copy.W_downsized,
+        )
+        if signature != self.batch_postprocessing_graphs_signature:
+            # The graphs are replayed one after the other on the same stream, so they can share a memory pool.
+            graph_pool = torch.cuda.graph_pool_handle()
+            self.batch_postprocessing_graphs = [
+                BatchPostprocessingGraph(cpu_batches, graph_pool) for _ in range(n_batch_postprocessing_graphs)
+            ]
+            self.batch_postprocessing_graphs_signature = signature
+        self.n_batches_collated += 1
+        return self.batch_postprocessing_graphs[self.n_batches_collated % len(self.batch_postprocessing_graphs)]
+
+    def __call__(self, batch: ExperienceBatch) -> tuple[Tensor, ...]:
+        if self.transfer_event is not None:
+            # The pinned buffers about to be refilled may still be read by the previous batch's asynchronous copy.
+            self.transfer_event.synchronize()
+
+        cpu_batches = [self.fast_collate_cpu(batch, attr_name) for attr_name in collated_attr_names]
+
+        # Only pinned copies are done on CPU. The mini-race horizon sampling and the n-step gather/mask run on GPU after the transfer.
+        # Copies are spread over several side streams so that they can be in flight simultaneously.
+        if not self.copy_streams:
+            self.copy_streams = [torch.cuda.Stream() for _ in range(n_copy_streams)]
+        current_stream = torch.cuda.current_stream()
+        if config_copy.use_cuda_graph_for_batch_postprocessing:
+            batch_postprocessing_graph = self.get_batch_postprocessing_graph(cpu_batches)
+            for copy_stream in self.copy_streams:
+                # Static inputs may still be read by work previously queued on the current stream.
+                copy_stream.wait_stream(current_stream)
+            for i, (cpu_batch, static_input) in enumerate(zip(cpu_batches, batch_postprocessing_graph.static_inputs)):
+                with torch.cuda.stream(self.copy_streams[i % len(self.copy_streams)]):
+                    static_input.copy_(cpu_batch, non_blocking=True)
+        else:
+            gpu_batches = []
+            for i, (cpu_batch, attr_name) in enumerate(zip(cpu_batches, collated_attr_names)):
+                with torch.cuda.stream(self.copy_streams[i % len(self.copy_streams)]):
+                    gpu_batches.append(send_to_gpu(cpu_batch, attr_name))
+        for copy_stream in self.copy_streams:
+            current_stream.wait_stream(copy_stream)
+        self.transfer_event = torch.cuda.Event()
+        self.transfer_event.record()
+
+        if config_copy.use_cuda_graph_for_batch_postprocessing:
+            return batch_postprocessing_graph.replay()
+
+        for gpu_batch in gpu_batches:
+            # Tensors were allocated on a side stream: prevent the caching allocator from reusing them while the current stream needs them.
+            gpu_batch.record_stream(current_stream)
+
+        return postprocess_batch_on_gpu(gpu_batches)
+
+
+class CustomPrioritizedSampler(Sampler):
     """
     Custom Prioritized Sampler which implements a slightly modified behavior compared to torchrl's original implementation.
 
@@ -186,10 +431,21 @@ class CustomPrioritizedSampler(PrioritizedSampler):
         reduction: str = "max",
         default_priority_ratio: float = 2.0,
     ) -> None:
-        super(CustomPrioritizedSampler, self).__init__(max_capacity, alpha, beta, eps, dtype, reduction)
+        super().__init__()
+        self._max_capacity = max_capacity
+        self._alpha = alpha
+        self._beta = beta
+        self._eps = eps
+        self.reduction = reduction
+        self.dtype = dtype
         self._average_priority = None
         self._default_priority_ratio = default_priority_ratio
         self._uninitialized_memories = 0.0
+        # Priorities are stored in a flat tensor on GPU instead of torchrl's CPU segment trees.
+        # Sampling is a single cumsum + searchsorted, which beats per-sample tree traversals for our buffer sizes.
+        self._priorities = torch.zeros(max_capacity, dtype=dtype, device="cuda")
+        # The cumulative sum only changes when priorities are written: it is reused between consecutive calls to sample().
+        self._cumsum_cache = None
 
     @property
     def default_priority(self) -> float:
@@ -199,26 +455,46 @@ class CustomPrioritizedSampler(PrioritizedSampler):
         else:
             return self._default_priority_ratio * self._average_priority
 
-    def sample(self, storage: Storage, batch_size: int) -> tuple[Tensor, dict[str, Any]]:
+    def priorities(self, n: int) -> np.ndarray:
+        """Returns the priorities of the first n memories as a numpy array."""
+        return self._priorities[:n].cpu().numpy()
+
+    def sample(self, storage: Storage, batch_size: int) -> tuple[np.ndarray, dict[str, Any]]:
         if len(storage) == 0:
             raise RuntimeError("Cannot sample from an empty storage.")
-        p_sum = self._sum_tree.query(0, len(storage))
+        if self._cumsum_cache is None or len(self._cumsum_cache[0]) != len(storage):
+            cumsum = torch.cumsum(self._priorities[: len(storage)], dim=0)
+            self._cumsum_cache = (cumsum, cumsum[-1].item())
+        cumsum, p_sum = self._cumsum_cache
         self._average_priority = p_sum / len(storage)
         if p_sum <= 0:
             raise RuntimeError("negative p_sum")
-        mass = np.random.uniform(0.0, p_sum, size=batch_size)
-        index = self._sum_tree.scan_lower_bound(mass)
-        if not isinstance(index, np.ndarray):
-            index = np.array([index])
-        if isinstance(index, torch.Tensor):
-            index.clamp_max_(len(storage) - 1)
-        else:
-            index = np.clip(index, None, len(storage) - 1)
+        # Stratified sampling as in the PER paper: [0, p_sum] is split in batch_size equal segments, with one draw per segment.
+        mass = (torch.arange(batch_size, dtype=cumsum.dtype, device="cuda") + torch.rand(batch_size, dtype=cumsum.dtype, device="cuda")) * (
+            p_sum / batch_size
+        )
+        index = torch.searchsorted(cumsum, mass, right=True).clamp_max_(len(storage) - 1)
         if self._uninitialized_memories > 0.0:
-            return index, {"_weight": 0.5 * np.ones(len(index))}
+            return index.cpu().numpy(), {"_weight": 0.5 * np.ones(batch_size)}
         else:
-            weight = np.power((len(storage) * self._sum_tree[index] / p_sum), -self._beta)
-            return index, {"_weight": weight}
+            weight = (len(storage) * self._priorities[index] / p_sum).pow_(-self._beta)
+            return index.cpu().numpy(), {"_weight": weight.cpu().numpy()}
+
+    def _empty(self) -> None:
+        self._priorities.zero_()
+        self._cumsum_cache = None
+
+    def add(self, index: int) -> None:
+        self._add_or_extend(index)
+
+    def extend(self, index: torch.Tensor) -> None:
+        self._add_or_extend(index)
+
+    def _add_or_extend(self, index: Union[int, torch.Tensor]) -> None:
+        if not isinstance(index, INT_CLASSES):
+            index = torch.as_tensor(index, device="cuda")
+        self._priorities[index] = self.default_priority
+        self._cumsum_cache = None
 
     def update_priority(self, index: Union[int, torch.Tensor], priority: Union[float, torch.Tensor]) -> None:
         """Updates the priority of the data pointed by the index.
@@ -239,12 +515,12 @@ class CustomPrioritizedSampler(PrioritizedSampler):
         else:
             if not (isinstance(priority, float) or len(priority) == 1 or len(index) == len(priority)):
                 raise RuntimeError("priority should be a number or an iterable of the same " "length as index")
-            index = _to_numpy(index)
-            priority = _to_numpy(priority)
+            index = torch.as_tensor(index, device="cuda")
             # We track the _approximate_ number of memories in the buffer that have default priority :
             self._uninitialized_memories -= 0.3 * len(index)
-        priority = np.power(priority + self._eps, self._alpha)
-        self._sum_tree[index] = priority
+        priority = torch.as_tensor(priority, dtype=self._priorities.dtype, device="cuda")
+        self._priorities[index] = (priority + self._eps).pow_(self._alpha)
+        self._cumsum_cache = None
 
     def state_dict(self) -> Dict[str, Any]:
         return {
@@ -253,7 +529,7 @@ class CustomPrioritizedSampler(PrioritizedSampler):
             "_eps": self._eps,
             "_average_priority": self._average_priority,
             "_default_priority_ratio": self._default_priority_ratio,
-            "_sum_tree": deepcopy(self._sum_tree),
+            "_priorities": self._priorities.cpu(),
         }
 
     def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
@@ -262,28 +538,39 @@ class CustomPrioritizedSampler(PrioritizedSampler):
         self._eps = state_dict["_eps"]
         self._average_priority = state_dict["_average_priority"]
         self._default_priority_ratio = state_dict["_default_priority_ratio"]
-        self._sum_tree = state_dict.pop("_sum_tree")
+        self._priorities = state_dict.pop("_priorities").to("cuda")
+        self._cumsum_cache = None
+
+    def dumps(self, path) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        torch.save(self.state_dict(), path / "sampler_state_dict.pt")
+
+    def loads(self, path) -> None:
+        self.load_state_dict(torch.load(Path(path) / "sampler_state_dict.pt"))
 
 
 def copy_buffer_content_to_other_buffer(source_buffer: ReplayBuffer, target_buffer: ReplayBuffer) -> None:
     assert source_buffer._storage.max_size <= target_buffer._storage.max_size
 
-    target_buffer.extend(source_buffer._storage._storage)
+    if len(source_buffer) > 0:
+        # Slices of the source storage's arrays are written to the target storage directly, without rebuilding Experience objects.
+        target_buffer.extend(
+            ExperienceBatch({attr_name: array[: len(source_buffer)] for attr_name, array in source_buffer._storage._arrays.items()})
+        )
 
     if isinstance(source_buffer._sampler, CustomPrioritizedSampler) and isinstance(target_buffer._sampler, CustomPrioritizedSampler):
         target_buffer._sampler._average_priority = source_buffer._sampler._average_priority
         target_buffer._sampler._uninitialized_memories = source_buffer._sampler._uninitialized_memories
-
-    if isinstance(source_buffer._sampler, PrioritizedSampler) and isinstance(target_buffer._sampler, PrioritizedSampler):
-        for i in range(len(source_buffer)):
-            target_buffer._sampler._sum_tree[i] = source_buffer._sampler._sum_tree.at(i)
+        target_buffer._sampler._priorities[: len(source_buffer)] = source_buffer._sampler._priorities[: len(source_buffer)]
+        target_buffer._sampler._cumsum_cache = None
 
 
 def make_buffers(buffer_size: int) -> tuple[ReplayBuffer, ReplayBuffer]:
     buffer = ReplayBuffer(
-        storage=ListStorage(buffer_size),
+        storage=ExperienceArrayStorage(buffer_size),
         batch_size=config_copy.batch_size,
-        collate_fn=buffer_collate_function,
+        collate_fn=BufferCollator(),
         prefetch=1,
         sampler=CustomPrioritizedSampler(
             buffer_size, config_copy.prio_alpha, config_copy.prio_beta, config_copy.prio_epsilon, torch.float64
@@ -292,9 +579,9 @@ def make_buffers(buffer_size: int) -> tuple[ReplayBuffer, ReplayBuffer]:
         else RandomSampler(),
     )
     buffer_test = ReplayBuffer(
-        storage=ListStorage(int(buffer_size * config_copy.buffer_test_ratio)),
+        storage=ExperienceArrayStorage(int(buffer_size * config_copy.buffer_test_ratio)),
         batch_size=config_copy.batch_size,
-        collate_fn=buffer_collate_function,
+        collate_fn=BufferCollator(),
         sampler=CustomPrioritizedSampler(
             buffer_size, config_copy.prio_alpha, config_copy.prio_beta, config_copy.prio_epsilon, torch.float64
         )
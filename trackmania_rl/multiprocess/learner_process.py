@@ -16,7 +16,6 @@ import numpy as np
 import torch
 from torch import multiprocessing as mp
 from torch.utils.tensorboard import SummaryWriter
-from torchrl.data.replay_buffers import PrioritizedSampler
 
 from config_files import config_copy
 from trackmania_rl import buffer_management, utilities
@@ -29,7 +28,7 @@ from trackmania_rl.analysis_metrics import (
     race_time_left_curves,
     tau_curves,
 )
-from trackmania_rl.buffer_utilities import make_buffers, resize_buffers
+from trackmania_rl.buffer_utilities import CustomPrioritizedSampler, make_buffers, resize_buffers
 from trackmania_rl.map_reference_times import reference_times
 
 
@@ -280,7 +279,7 @@ def learner_process_fn(
             param_group["epsilon"] = config_copy.adam_epsilon
             param_group["betas"] = (config_copy.adam_beta1, config_copy.adam_beta2)
 
-        if isinstance(buffer._sampler, PrioritizedSampler):
+        if isinstance(buffer._sampler, CustomPrioritizedSampler):
             buffer._sampler._alpha = config_copy.prio_alpha
             buffer._sampler._beta = config_copy.prio_beta
             buffer._sampler._eps = config_copy.prio_epsilon
@@ -574,8 +573,8 @@ def learner_process_fn(
                             f"{key}_max": np.max(val),
                         }
                     )
-            if isinstance(buffer._sampler, PrioritizedSampler):
-                all_priorities = np.array([buffer._sampler._sum_tree.at(i) for i in range(len(buffer))])
+            if isinstance(buffer._sampler, CustomPrioritizedSampler):
+                all_priorities = buffer._sampler.priorities(len(buffer))
                 step_stats.update(
                     {
                         "priorities_min": np.min(all_priorities),
@@ -682,8 +681,9 @@ def learner_process_fn(
             #   BUFFER STATS
             # ===============================================
 
-            mean_in_buffer = np.array([experience.state_float for experience in buffer._storage]).mean(axis=0)
-            std_in_buffer = np.array([experience.state_float for experience in buffer._storage]).std(axis=0)
+            state_float_in_buffer = buffer._storage._arrays["state_float"][: len(buffer)]
+            mean_in_buffer = state_float_in_buffer.mean(axis=0)
+            std_in_buffer = state_float_in_buffer.std(axis=0)
 
             print("Raw mean in buffer  :", mean_in_buffer.round(1))
             print("Raw std in buffer   :", std_in_buffer.round(1))
@@ -701,7 +701,7 @@ def learner_process_fn(
             # ===============================================
             #   HIGH PRIORITY TRANSITIONS
             # ===============================================
-            if config_copy.make_highest_prio_figures and isinstance(buffer._sampler, PrioritizedSampler):
+            if config_copy.make_highest_prio_figures and isinstance(buffer._sampler, CustomPrioritizedSampler):
                 highest_prio_transitions(buffer, save_dir)
 
             # ===============================================